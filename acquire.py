@@ -1,16 +1,21 @@
 import usbtmc
 import time
 import numpy as np
-import matplotlib.pyplot as plt
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtWidgets
 import logging
+from scope_pipeline import make_rescale, load_frame, parse_block, is_timeout, CapturePipeline, RawWriter
 
 # --- Logging Configuration ---
 # This sets up the logger to print messages to the console.
 # The format includes a timestamp, the level of the message (e.g., INFO), and the message itself.
 logging.basicConfig(
-    level=logging.INFO,
+    level=logging.INFO, # Set to INFO for cleaner output, DEBUG for timings
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
+# Per-step timings are logged at DEBUG level. Checking the level once keeps the
+# timing calls (and their formatting) off the hot path unless DEBUG is enabled.
+log_timings = logging.getLogger().isEnabledFor(logging.DEBUG)
 
 # --- Oscilloscope Configuration ---
 # Your specific Tektronix Scope IDs
@@ -19,20 +24,35 @@ SCOPE_PID = 0x03b3
 
 WAVEFORM_SOURCE = 'CH2'
 NUM_CAPTURES = 100  # How many waveforms to capture before stopping
+PLOT_EVERY_N_FRAMES = 5  # Only update the live plot every N frames
+PLOT_REFRESH_HZ = 60  # ...and never faster than the display refreshes
+PIPELINE_DEPTH = 2  # Captured frames allowed to wait while the previous one is processed
+SAVE_QUEUE_SIZE = 64  # Frames allowed to wait for the background writer
+
+# FastFrame: on scopes that support it, capture all NUM_CAPTURES frames in a single
+# armed acquisition and transfer them with one CURVE?, instead of one arm/transfer
+# per frame. Other models fall back to one acquisition per frame.
+USE_FASTFRAME = True
+FASTFRAME_MODELS = ('DPO5', 'MSO5', 'DPO7', 'MSO7', 'DSA7')  # Model name prefixes from *IDN?
+FASTFRAME_TIMEOUT = 60  # s, the single CURVE? has to wait for all NUM_CAPTURES triggers
 
 # --- Main Script ---
 
-# --- Matplotlib Setup for Live Plotting ---
-plt.ion() # Turn on interactive mode
-fig, ax = plt.subplots()
-line, = ax.plot([], []) # Create an empty line object to update
+# --- PyQtGraph Setup for Live Plotting ---
+app = pg.mkQApp("Live Waveform")
+win = pg.GraphicsLayoutWidget(show=True, title="Live Waveform from Oscilloscope")
+win.resize(1000, 600)
+
+# Enable antialiasing for prettier plots
+pg.setConfigOptions(antialias=True)
 
 # Configure plot aesthetics
-ax.set_title("Live Waveform from Oscilloscope")
-ax.set_xlabel("Time (s)")
-ax.set_ylabel("Voltage (V)")
-ax.grid(True)
-# --- End of Matplotlib Setup ---
+p1 = win.addPlot(title="Live Waveform from Oscilloscope")
+p1.setLabel('left', "Voltage", units='V')
+p1.setLabel('bottom', "Time", units='s')
+p1.showGrid(x=True, y=True)
+curve = p1.plot(pen='y') # Empty curve object to update
+# --- End of PyQtGraph Setup ---
 
 print("Searching for USBTMC instrument...")
 try:
@@ -47,23 +67,56 @@ except Exception as e:
 try:
     instrument_id = scope.ask('*IDN?')
     logging.info(f"Connected to: {instrument_id.strip()}")
+    # *IDN? looks like TEKTRONIX,DPO7254,C012345,CF:91.1CT FV:6.4.0
+    model = instrument_id.split(',')[1].strip() if ',' in instrument_id else ''
+    fastframe = USE_FASTFRAME and model.startswith(FASTFRAME_MODELS)
+    if fastframe:
+        # CURVE? returns DATA:START..DATA:STOP of every frame, so transfer whole
+        # records: the block is split into frames at this stride
+        record_length = int(scope.ask('HORIZONTAL:RECORDLENGTH?'))
     
-    scope.write(f'DATA:SOURCE {WAVEFORM_SOURCE}')
-    scope.write('DATA:ENCDG RIBinary')
-    scope.write('DATA:WIDTH 1')
-    scope.write('HEADER OFF')
-    scope.write('ACQUIRE:STOPAFTER SEQUENCE')
+    # All setup commands go out in one semicolon-chained write (one USB round-trip)
+    setup_commands = [
+        f'DATA:SOURCE {WAVEFORM_SOURCE}',
+        'DATA:ENCDG RIBinary',
+        'DATA:WIDTH 1',
+        'HEADER OFF',
+        'ACQUIRE:STOPAFTER SEQUENCE',
+    ]
+    if fastframe:
+        setup_commands += [
+            'HORIZONTAL:FASTFRAME:STATE ON',
+            f'HORIZONTAL:FASTFRAME:COUNT {NUM_CAPTURES}',
+            'DATA:FRAMESTART 1',
+            f'DATA:FRAMESTOP {NUM_CAPTURES}',
+            'DATA:START 1',
+            f'DATA:STOP {record_length}',
+        ]
+    scope.write(';:'.join(setup_commands))
 
-    logging.info("Scope configured for fast binary acquisition.")
+    if fastframe:
+        scope.timeout = FASTFRAME_TIMEOUT
+        logging.info(f"Scope configured for FastFrame binary acquisition ({NUM_CAPTURES} frames).")
+    else:
+        logging.info("Scope configured for fast binary acquisition.")
 
     # --- Query and Log Waveform Scaling Parameters (Done ONCE) ---
     logging.info("Querying waveform scaling parameters...")
-    num_points = int(scope.ask('WFMPRE:NR_PT?'))
-    x_increment = float(scope.ask('WFMPRE:XINCR?'))
-    x_origin = float(scope.ask('WFMPRE:XZERO?'))
-    y_multiplier = float(scope.ask('WFMPRE:YMULT?'))
-    y_offset = float(scope.ask('WFMPRE:YOFF?'))
-    y_zero = float(scope.ask('WFMPRE:YZERO?'))
+    # The fields and their order in a bare WFMPRE? reply differ between Tek
+    # families, so ask for exactly the ones we need in one compound query. The
+    # reply comes back in query order (HEADER OFF, ';'-separated).
+    preamble = scope.ask('WFMPRE:NR_PT?;XINCR?;XZERO?;YMULT?;YOFF?;YZERO?').strip().split(';')
+    if len(preamble) != 6:
+        raise ValueError(f"Unexpected WFMPRE reply: {';'.join(preamble)}")
+    num_points = int(preamble[0])
+    x_increment = float(preamble[1])
+    x_origin = float(preamble[2])
+    y_multiplier = float(preamble[3])
+    y_offset = float(preamble[4])
+    y_zero = float(preamble[5])
+    if fastframe:
+        # Points per frame, as set with DATA:START/STOP above
+        num_points = record_length
 
     # Use a multi-line f-string to format the log message for readability
     parameter_log_message = f"""
@@ -78,6 +131,13 @@ try:
     -------------------------------------------
     """
     logging.info(parameter_log_message)
+
+    # Make sure a whole CURVE? response (header + samples) fits in one bulk transfer.
+    # python-usbtmc already defaults to 1 MiB, so this only changes anything for
+    # longer responses, e.g. a FastFrame CURVE? covering every frame.
+    curve_points = num_points * NUM_CAPTURES if fastframe else num_points
+    if curve_points + 32 > scope.max_transfer_size:
+        scope.max_transfer_size = curve_points + 32
     # --- End of Parameter Logging ---
 
 except Exception as e:
@@ -85,69 +145,138 @@ except Exception as e:
     scope.close()
     exit()
 
+# --- Time Axis, Rescaling Constants and Output Buffer (Done ONCE) ---
+# num_points, x_increment and x_origin never change during a run, so the time
+# axis is computed here and reused for every capture. It stays in float64: with
+# a large XZERO, float32 can't resolve one sample step.
+times = np.arange(num_points, dtype=np.float64) * x_increment + x_origin
+rescale_offset = np.float32(y_zero - y_offset)
+rescale_gain = np.float32(y_multiplier)
+raw_buf = np.empty(num_points, dtype=np.int8)
+volt_buf = np.full(num_points, np.nan, dtype=np.float32)
+# Compile the fixed-length kernel now (first call) so JIT time isn't added to the
+# first captured frame
+rescale_full = make_rescale(num_points)
+rescale_full(raw_buf, rescale_offset, rescale_gain, volt_buf)
+volt_buf[:] = np.nan
+
+# --- Fixed Plot Limits (Done ONCE) ---
+# int8 samples can only span -128..127, so the voltage range is known up front and
+# the plot never has to auto-range over the data.
+v_lo = (-128 - y_zero + y_offset) * y_multiplier
+v_hi = (127 - y_zero + y_offset) * y_multiplier
+p1.setYRange(min(v_lo, v_hi), max(v_lo, v_hi), padding=0)
+p1.setXRange(times[0], times[-1], padding=0)
+
+# --- Raw Output File (Opened ONCE) ---
+# Raw int8 ADC samples from every capture are saved to run_<timestamp>.i8 by a
+# background writer, with the scaling parameters in a .json sidecar.
+run_name = f'run_{time.strftime("%Y%m%d-%H%M%S")}'
+writer = RawWriter(run_name, {
+    'scope': 'tektronix',
+    'x_increment': x_increment,
+    'x_origin': x_origin,
+    'y_multiplier': y_multiplier,
+    'y_offset': y_offset,
+    'y_zero': y_zero,
+}, NUM_CAPTURES, num_points, SAVE_QUEUE_SIZE)
+logging.info(f"Saving raw waveforms to {run_name}.i8")
+
+# --- Capture Pipeline (runs on a background thread, see scope_pipeline.py) ---
+def capture_frame():
+    # --- Trigger and Get the Raw Waveform Data in One Command ---
+    # ;*WAI makes the scope hold back the CURVE? response until the acquisition
+    # has completed, which replaces the separate *OPC? round-trip.
+    if log_timings:
+        start_time = time.perf_counter()
+    scope.write('ACQUIRE:STATE ON;*WAI;:CURVE?')
+    waveform_bytes = scope.read_raw()
+    if log_timings:
+        logging.debug("  scope.read_raw() took %.6f s", time.perf_counter() - start_time)
+    # Strip the IEEE 488.2 header (e.g. #41000) on the capture thread
+    return parse_block(waveform_bytes)
+
+def capture_fastframe():
+    # A block of any other length can't be split into frames at the right
+    # stride, so reject it rather than save shifted frames
+    block = capture_frame()
+    if len(block) != NUM_CAPTURES * num_points:
+        raise ValueError(f"FastFrame block has {len(block)} points, expected "
+                         f"{NUM_CAPTURES} frames of {num_points}")
+    return block
+
+# In FastFrame mode the thread makes a single capture and splits it into frames
+if fastframe:
+    capture = CapturePipeline(capture_fastframe, 1, PIPELINE_DEPTH, frame_points=num_points)
+else:
+    capture = CapturePipeline(capture_frame, NUM_CAPTURES, PIPELINE_DEPTH)
+
 # --- Acquisition Loop ---
 print("\nStarting capture loop...")
+# Rates are reported as frames over wall time since capture.start(). In FastFrame
+# mode the first frame carries the whole acquisition and transfer and the rest
+# arrive almost at once, so an average of per-frame rates would be meaningless.
+frames_done = 0
+last_paint = 0.0
+run_start = time.perf_counter()
+capture.start()
 for i in range(NUM_CAPTURES):
     loop_start_time = time.time()
     
     try:
-        start_time = time.perf_counter()
-        scope.write('ACQUIRE:STATE ON')
-        duration = time.perf_counter() - start_time
-        logging.info(f"  scope.write('ACQUIRE:STATE ON') took {duration:.6f} s")
-        start_time = time.perf_counter()
-        scope.ask('*OPC?') 
-        duration = time.perf_counter() - start_time
-        logging.info(f"  scope.ask('*OPC?') took {duration:.6f} s")
-
-        # --- Get the Raw Waveform Data ---
-        start_time = time.perf_counter()
-        scope.write('CURVE?')
-        waveform_bytes = scope.read_raw()
-        duration = time.perf_counter() - start_time
-        logging.info(f"  scope.read_raw() took {duration:.6f} s")
-        raw_waveform = np.frombuffer(waveform_bytes, dtype=np.int8)
+        raw_waveform = capture.get()
+        if raw_waveform is None:
+            # The capture thread ran out of frames (e.g. a short FastFrame block)
+            break
+        if isinstance(raw_waveform, Exception):
+            raise raw_waveform
 
         # --- Data Processing (using pre-fetched parameters) ---
-        start_time = time.perf_counter()
-        voltages = (raw_waveform.astype(np.float32) - y_zero + y_offset) * y_multiplier
-        times = np.arange(0, len(raw_waveform)) * x_increment + x_origin
-
-        # --- Update Live Plot ---
-        line.set_xdata(times)
-        line.set_ydata(voltages)
-        ax.relim()
-        ax.autoscale_view()
-        fig.canvas.draw()
-        fig.canvas.flush_events()
-        
-        # --- Save to CSV (Optional) ---
-        # You can comment/uncomment this section if you still want to save the data
-        filename = f'waveform_{i+1:03d}_{time.strftime("%Y%m%d-%H%M%S")}.csv'
-        data_to_save = np.vstack((times, voltages)).T
-        np.savetxt(filename, data_to_save, delimiter=',', header='Time(s),Voltage(V)', comments='')
+        if log_timings:
+            start_time = time.perf_counter()
+        n = load_frame(raw_waveform, raw_buf, volt_buf, rescale_full, rescale_offset, rescale_gain)
+
+        # --- Update Live Plot (only every Nth frame) ---
+        if (i + 1) % PLOT_EVERY_N_FRAMES == 0:
+            now = time.perf_counter()
+            if now - last_paint >= 1.0 / PLOT_REFRESH_HZ:
+                # The title is repainted with the curve, so it is only set here too
+                curve.setData(times, volt_buf)
+                p1.setTitle(f"Live Waveform (Capture {i+1}/{NUM_CAPTURES}, Rate: {frames_done / (now - run_start):.2f} Hz)")
+                app.processEvents()
+                last_paint = now
+
+        # --- Save Raw Samples (Optional) ---
+        # You can comment/uncomment this line if you don't want to save the data
+        writer.put(i, raw_buf[:n])
                 
         loop_end_time = time.time()
         elapsed_time = loop_end_time - loop_start_time
         actual_rate = 1.0 / elapsed_time if elapsed_time > 0 else 0
+        frames_done += 1
 
-        duration = time.perf_counter() - start_time
-        logging.info(f"Data processing and plotting took {duration:.6f} s")
-
-        ax.set_title(f"Live Waveform (Capture {i+1}/{NUM_CAPTURES}, Rate: {actual_rate:.2f} Hz)")
-        logging.info(f"Live Waveform (Capture {i+1}/{NUM_CAPTURES}, Rate: {actual_rate:.2f} Hz)")
+        if log_timings:
+            logging.debug("Data processing and plotting took %.6f s", time.perf_counter() - start_time)
+            logging.debug("Live Waveform (Capture %d/%d, Rate: %.2f Hz)", i + 1, NUM_CAPTURES, actual_rate)
     except Exception as e:
         logging.error(f"An error occurred during capture {i+1}: {e}")
-        if "Timeout" in str(e):
+        if is_timeout(e):
             logging.warning("Timeout Error: The scope may not be triggering. Check the trigger source and level.")
             break
         continue
 
 # --- Cleanup ---
-logging.info("Acquisition complete.")
+run_time = time.perf_counter() - run_start
+average_rate = frames_done / run_time if run_time > 0 else 0
+logging.info(f"Acquisition complete. Average rate: {average_rate:.2f} Hz")
+capture.stop()
+writer.close()
+if fastframe:
+    # Leave the scope in normal single-record acquisition for the next user
+    scope.write('HORIZONTAL:FASTFRAME:STATE OFF')
 scope.close()
 
 # Keep the final plot window open
-plt.ioff()
-ax.set_title("Acquisition Finished - Final Waveform")
-plt.show()
\ No newline at end of file
+curve.setData(times, volt_buf)
+p1.setTitle("Acquisition Finished - Final Waveform")
+QtWidgets.QApplication.instance().exec_()
@@ -1,10 +1,12 @@
 import usbtmc
 import time
+import queue
 import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 import logging
 import sys
+from scope_pipeline import parse_block, is_timeout, CapturePipeline, RawWriter
 
 # --- Configuration ---
 logging.basicConfig(
@@ -29,12 +31,25 @@ NUM_CAPTURES = 300
 #    Lower values result in much faster acquisitions.
 ACQUISITION_POINTS = 1000 # Try 1000, 500, or even 250
 #
-# 2. Only update the plot every N frames.
+# 2. Only update the plot every N frames, and never faster than the display refreshes.
 PLOT_EVERY_N_FRAMES = 5 
+PLOT_REFRESH_HZ = 60
+#
+# 3. Keep the next capture in flight while the previous one is processed.
+PIPELINE_DEPTH = 2 # Captured frames allowed to wait for processing
+SAVE_QUEUE_SIZE = 64 # Frames allowed to wait for the background writer
+#
+# 4. Optionally cap the capture rate (0 = as fast as possible).
+TARGET_RATE_HZ = 0
 #
 # ============================================
 #
 
+# --- :WAVEFORM:PREAMBLE? Field Indices ---
+PREAMBLE_POINTS = 2
+PREAMBLE_XINC, PREAMBLE_XORG = 4, 5
+PREAMBLE_YINC, PREAMBLE_YORG, PREAMBLE_YREF = 7, 8, 9
+
 # --- PyQtGraph Setup ---
 app = pg.mkQApp("Live Waveform")
 win = pg.GraphicsLayoutWidget(show=True, title="Live Waveform from Agilent DSO9104A")
@@ -57,97 +72,191 @@ try:
     logging.info(f"Connected to: {scope.ask('*IDN?').strip()}")
     
     # --- Configure scope using AGILENT commands ---
-    scope.write(':STOP') # Stop acquisition to change settings
-    scope.write(f':WAVEFORM:SOURCE {WAVEFORM_SOURCE}')
-    scope.write(':WAVEFORM:FORMAT BYTE') # Use 8-bit data for speed
-    scope.write(':WAVEFORM:UNSIGNED OFF')
-    scope.write(f':ACQUIRE:POINTS {ACQUISITION_POINTS}') # Set the record length!
-    scope.write(':ACQUIRE:TYPE NORMAL')
+    # All setup commands go out in one semicolon-chained write (one USB round-trip)
+    scope.write(';'.join([
+        ':STOP', # Stop acquisition to change settings
+        f':WAVEFORM:SOURCE {WAVEFORM_SOURCE}',
+        ':WAVEFORM:FORMAT BYTE', # Use 8-bit data for speed
+        ':WAVEFORM:UNSIGNED OFF',
+        f':ACQUIRE:POINTS {ACQUISITION_POINTS}', # Set the record length!
+        ':ACQUIRE:TYPE NORMAL',
+    ]))
     logging.info(f"Scope configured with record length = {ACQUISITION_POINTS} points.")
 
     # --- Query scaling parameters using AGILENT commands ---
     logging.info("Querying waveform scaling parameters...")
     # The :WAVEFORM:PREAMBLE? command is a fast way to get all params at once
-    preamble = scope.ask(':WAVEFORM:PREAMBLE?').split(',')
+    preamble = scope.ask(':WAVEFORM:PREAMBLE?')
     
     # Parse the preamble for Agilent scopes
-    # Format: format,type,points,count,xinc,xorg,xref,yinc,yorg,yref
-    x_increment = float(preamble[4])
-    x_origin = float(preamble[5])
-    y_increment = float(preamble[7])
-    y_origin = float(preamble[8])
-    y_reference = int(float(preamble[9])) # Y-reference is the ADC level for 0 Volts
+    # Format: format,type,points,count,xinc,xorg,xref,yinc,yorg,yref,...
+    # The first ten fields are numeric and are converted to float64 in one NumPy call.
+    # Infiniium appends text fields (coupling, date, ...) which np.fromstring
+    # can't parse, so those are cut off first.
+    pa = np.array(preamble.split(',')[:10], dtype=np.float64)
+    x_increment, x_origin = pa[PREAMBLE_XINC], pa[PREAMBLE_XORG]
+    y_increment, y_origin = pa[PREAMBLE_YINC], pa[PREAMBLE_YORG]
+    y_reference = int(pa[PREAMBLE_YREF]) # Y-reference is the ADC level for 0 Volts
+    # The scope may not honour :ACQUIRE:POINTS exactly, so size everything from the
+    # record length it actually reports
+    num_points = int(pa[PREAMBLE_POINTS])
+    if num_points != ACQUISITION_POINTS:
+        logging.warning(f"Scope uses a record length of {num_points} points, not {ACQUISITION_POINTS}.")
+
+    # Make sure a whole :WAVEFORM:DATA? response fits in one bulk transfer.
+    # python-usbtmc already defaults to 1 MiB, so this only matters for records
+    # longer than that.
+    if num_points + 32 > scope.max_transfer_size:
+        scope.max_transfer_size = num_points + 32
     logging.info("Parameters acquired.")
 
 except Exception as e:
     logging.error(f"Error during setup: {e}")
     exit()
 
+# --- Time Axis and Sample Buffer (Done ONCE) ---
+# The record length, x_increment and x_origin never change during a run, so the time
+# axis is computed here and reused for every capture. It stays in float64: with
+# a large x_origin, float32 can't resolve one sample step.
+times = np.arange(num_points, dtype=np.float64) * x_increment + x_origin
+raw_buf = np.empty(num_points, dtype=np.int8)
+
+# --- Plot Raw ADC Levels, Scaled to Volts by the Curve's Transform ---
+# The curve is fed the int8 samples directly and its item transform maps them to
+# volts: (raw - y_reference) * y_increment + y_origin. No per-frame float
+# conversion is needed for display; read_waveforms.py rescales saved runs offline.
+curve.setTransform(QtGui.QTransform(1, 0, 0, y_increment, 0, y_origin - y_reference * y_increment))
+
+# --- Raw Output File (Opened ONCE) ---
+# Raw int8 samples are saved to run_<timestamp>.i8 by a background writer, with the
+# scaling parameters in a .json sidecar.
+run_name = f'run_{time.strftime("%Y%m%d-%H%M%S")}'
+writer = RawWriter(run_name, {
+    'scope': 'agilent',
+    'x_increment': x_increment,
+    'x_origin': x_origin,
+    'y_increment': y_increment,
+    'y_origin': y_origin,
+    'y_reference': y_reference,
+}, NUM_CAPTURES, num_points, SAVE_QUEUE_SIZE)
+logging.info(f"Saving raw waveforms to {run_name}.i8")
+
+# --- Capture Pipeline (runs on a background thread, see scope_pipeline.py) ---
+def capture_frame():
+    # --- Use the efficient :DIGITIZE command ---
+    # This performs a single-shot acquisition and is faster than run/stop.
+    # Ask for the data in the same write. The scope will send a binary block
+    # header (e.g., #800001000) which parse_block() strips on the capture thread.
+    scope.write(f':DIGITIZE {WAVEFORM_SOURCE};:WAVEFORM:DATA?')
+    return parse_block(scope.read_raw())
+
+# The capture thread emits frame_ready after every frame it queues. The signal is
+# delivered to update() through a queued connection, so update() runs on the GUI
+# thread only when a frame is waiting, with no timer polling in between.
+class FrameNotifier(QtCore.QObject):
+    frame_ready = QtCore.Signal()
+
+notifier = FrameNotifier()
+capture = CapturePipeline(capture_frame, NUM_CAPTURES, PIPELINE_DEPTH,
+                          on_frame=notifier.frame_ready.emit)
+
 # --- Acquisition Loop ---
 logging.info("Starting capture loop...")
-all_rates = []
+# Running sum/count of the frame rates, so the average is O(1) per frame
+rate_sum = 0.0
+rate_count = 0
+last_paint = 0.0
+last_frame_time = 0.0 # When the previous frame finished (or the capture started)
+throttled = False # update() is being held back by TARGET_RATE_HZ
+finished = False
+
+def finish():
+    global finished
+    finished = True
+    average_rate = rate_sum / rate_count if rate_count else 0
+    logging.info(f"Acquisition complete. Average rate: {average_rate:.2f} Hz")
+    capture.stop()
+    writer.close()
+    scope.write(':RUN') # Let the scope run freely again
+    scope.close()
+    p1.setTitle(f"Finished (Avg Rate: {average_rate:.2f} Hz)")
+
+def release():
+    # The TARGET_RATE_HZ delay is over: handle the next waiting frame, if any
+    global throttled
+    throttled = False
+    update()
 
 def update():
-    global i, all_rates
+    global i, rate_sum, rate_count, last_paint, last_frame_time, throttled
     
-    # Check if we are done
-    if i >= NUM_CAPTURES:
-        timer.stop()
-        average_rate = np.mean(all_rates) if all_rates else 0
-        logging.info(f"Acquisition complete. Average rate: {average_rate:.2f} Hz")
-        scope.write(':RUN') # Let the scope run freely again
-        scope.close()
-        p1.setTitle(f"Finished (Avg Rate: {average_rate:.2f} Hz)")
+    # Frames that arrive while throttled stay queued until release()
+    if finished or throttled:
+        return
+    try:
+        raw_waveform = capture.get(block=False)
+    except queue.Empty:
+        # This frame's signal was already served by release()
         return
-
     loop_start_time = time.perf_counter()
     
     try:
-        # --- Use the efficient :DIGITIZE command ---
-        # This performs a single-shot acquisition and is faster than run/stop
-        scope.write(f':DIGITIZE {WAVEFORM_SOURCE}')
-        
-        # Ask for the data. The scope will send a binary block header (e.g., #800001000)
-        # which usbtmc.read_raw() should handle automatically.
-        scope.write(':WAVEFORM:DATA?')
-        waveform_bytes = scope.read_raw()
-        
-        # The first few bytes are the header, we need to find the start of the data
-        header_end_index = waveform_bytes.find(b'\n') + 1
-        raw_waveform = np.frombuffer(waveform_bytes[header_end_index:], dtype=np.int8)
+        if raw_waveform is None:
+            # The capture thread stopped early (e.g. after a timeout)
+            finish()
+            return
+        if isinstance(raw_waveform, Exception):
+            raise raw_waveform
 
-        voltages = (raw_waveform.astype(np.float32) - y_reference) * y_increment + y_origin
-        times = np.arange(0, len(raw_waveform)) * x_increment + x_origin
+        # Copy into the persistent buffer, truncating over-long reads
+        n = min(len(raw_waveform), num_points)
+        np.copyto(raw_buf[:n], raw_waveform[:n])
         
-        filename = f'waveform_{i+1:03d}_{time.strftime("%Y%m%d-%H%M%S")}.csv'
-        data_to_save = np.vstack((times, voltages)).T
-        np.savetxt(filename, data_to_save, delimiter=',', header='Time(s),Voltage(V)', comments='')
+        writer.put(i, raw_buf[:n])
 
         # --- Only plot every Nth frame ---
+        # update() runs inside the Qt event loop, which repaints once it returns,
+        # so there is no processEvents() call (it would also re-enter update()).
         if (i + 1) % PLOT_EVERY_N_FRAMES == 0:
-            curve.setData(times, voltages)
-            app.processEvents()
+            now = time.perf_counter()
+            if now - last_paint >= 1.0 / PLOT_REFRESH_HZ:
+                # The title is repainted with the curve, so it is only set here too
+                average_rate = rate_sum / rate_count if rate_count else 0
+                curve.setData(times[:n], raw_buf[:n])
+                p1.setTitle(f"Live Waveform (Plotted frame {i+1}, Avg Rate: {average_rate:.2f} Hz)")
+                last_paint = now
         
+        # The rate is frame to frame, so it includes the wait for the scope
         loop_end_time = time.perf_counter()
-        elapsed_time = loop_end_time - loop_start_time
-        all_rates.append(1.0 / elapsed_time if elapsed_time > 0 else 0)
-        
-        p1.setTitle(f"Live Waveform (Plotted frame {i+1}, Avg Rate: {np.mean(all_rates):.2f} Hz)")
+        elapsed_time = loop_end_time - last_frame_time
+        last_frame_time = loop_end_time
+        rate_sum += 1.0 / elapsed_time if elapsed_time > 0 else 0
+        rate_count += 1
         
     except Exception as e:
         logging.error(f"An error occurred during capture {i+1}: {e}")
-        timer.stop()
-        scope.close()
+        if is_timeout(e):
+            logging.warning("Timeout Error: The scope may not be triggering.")
+            finish()
+            return
 
     i += 1
+    if i >= NUM_CAPTURES:
+        finish()
+        return
+
+    # Optionally hold off the next frame to cap the rate
+    if TARGET_RATE_HZ:
+        delay_ms = max(0, int(1000 / TARGET_RATE_HZ - (time.perf_counter() - loop_start_time) * 1000))
+        throttled = True
+        QtCore.QTimer.singleShot(delay_ms, release)
 
 # Initialize counter
 i = 0
 
-# Use a QTimer to run the update loop
-timer = QtCore.QTimer()
-timer.timeout.connect(update)
-timer.start(0) # Run as fast as possible
+notifier.frame_ready.connect(update, QtCore.Qt.ConnectionType.QueuedConnection)
+last_frame_time = time.perf_counter()
+capture.start()
 
 if __name__ == '__main__':
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
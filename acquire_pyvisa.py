@@ -3,12 +3,16 @@ import time
 import numpy as np
 import matplotlib.pyplot as plt
 import logging
+from scope_pipeline import make_rescale, load_frame, is_timeout, CapturePipeline
 
 # --- Logging Configuration ---
 logging.basicConfig(
-    level=logging.INFO,
+    level=logging.INFO, # Set to INFO for cleaner output, DEBUG for timings
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
+# Per-step timings are logged at DEBUG level. Checking the level once keeps the
+# timing calls (and their formatting) off the hot path unless DEBUG is enabled.
+log_timings = logging.getLogger().isEnabledFor(logging.DEBUG)
 
 # --- Oscilloscope Configuration ---
 SCOPE_VID = '1689' 
@@ -16,6 +20,8 @@ SCOPE_PID = '947' # Note: PyVISA uses decimal for VID/PID
 
 WAVEFORM_SOURCE = 'CH2'
 NUM_CAPTURES = 100
+PIPELINE_DEPTH = 2  # Captured frames allowed to wait while the previous one is processed
+PLOT_REFRESH_HZ = 60  # Never redraw the live plot faster than the display refreshes
 
 # --- Main Script ---
 
@@ -69,23 +75,32 @@ try:
     instrument_id = scope.query('*IDN?')
     logging.info(f"Connected to: {instrument_id.strip()}")
     
-    scope.write(f'DATA:SOURCE {WAVEFORM_SOURCE}')
-    scope.write('DATA:ENCDG RIBinary')
-    scope.write('DATA:WIDTH 1')
-    scope.write('HEADER OFF')
-    scope.write('ACQUIRE:STOPAFTER SEQUENCE')
+    # All setup commands go out in one semicolon-chained write (one USB round-trip)
+    scope.write(';:'.join([
+        f'DATA:SOURCE {WAVEFORM_SOURCE}',
+        'DATA:ENCDG RIBinary',
+        'DATA:WIDTH 1',
+        'HEADER OFF',
+        'ACQUIRE:STOPAFTER SEQUENCE',
+    ]))
 
     logging.info("Scope configured for fast binary acquisition.")
 
     # --- Query Parameters ---
     logging.info("Querying waveform scaling parameters...")
     # .query() returns a string, so we cast to float/int
-    num_points = int(scope.query('WFMPRE:NR_PT?'))
-    x_increment = float(scope.query('WFMPRE:XINCR?'))
-    x_origin = float(scope.query('WFMPRE:XZERO?'))
-    y_multiplier = float(scope.query('WFMPRE:YMULT?'))
-    y_offset = float(scope.query('WFMPRE:YOFF?'))
-    y_zero = float(scope.query('WFMPRE:YZERO?'))
+    # The fields and their order in a bare WFMPRE? reply differ between Tek
+    # families, so ask for exactly the ones we need in one compound query. The
+    # reply comes back in query order (HEADER OFF, ';'-separated).
+    preamble = scope.query('WFMPRE:NR_PT?;XINCR?;XZERO?;YMULT?;YOFF?;YZERO?').strip().split(';')
+    if len(preamble) != 6:
+        raise ValueError(f"Unexpected WFMPRE reply: {';'.join(preamble)}")
+    num_points = int(preamble[0])
+    x_increment = float(preamble[1])
+    x_origin = float(preamble[2])
+    y_multiplier = float(preamble[3])
+    y_offset = float(preamble[4])
+    y_zero = float(preamble[5])
 
     parameter_log_message = f"""
     -------------------------------------------
@@ -100,84 +115,124 @@ try:
     """
     logging.info(parameter_log_message)
 
+    # Make sure a whole CURVE? response (header + samples) fits in one chunk
+    scope.chunk_size = max(scope.chunk_size, num_points + 64)
+
 except Exception as e:
     logging.error(f"Error during configuration: {e}")
     scope.close()
     exit()
 
+# --- Time Axis, Rescaling Constants and Output Buffer (Done ONCE) ---
+# num_points, x_increment and x_origin never change during a run, so the time
+# axis is computed here and reused for every capture. It stays in float64: with
+# a large XZERO, float32 can't resolve one sample step.
+times = np.arange(num_points, dtype=np.float64) * x_increment + x_origin
+rescale_offset = np.float32(y_zero - y_offset)
+rescale_gain = np.float32(y_multiplier)
+raw_buf = np.empty(num_points, dtype=np.int8)
+volt_buf = np.full(num_points, np.nan, dtype=np.float32)
+# Compile the fixed-length kernel now (first call) so JIT time isn't added to the
+# first captured frame
+rescale_full = make_rescale(num_points)
+rescale_full(raw_buf, rescale_offset, rescale_gain, volt_buf)
+volt_buf[:] = np.nan
+
+# --- Fixed Plot Limits (Done ONCE) ---
+# int8 samples can only span -128..127, so the voltage range is known up front and
+# Matplotlib doesn't have to rescan the data (relim/autoscale) on every frame.
+v_lo = (-128 - y_zero + y_offset) * y_multiplier
+v_hi = (127 - y_zero + y_offset) * y_multiplier
+ax.set_ylim(min(v_lo, v_hi), max(v_lo, v_hi))
+ax.set_xlim(times[0], times[-1])
+# Give the line its x and (NaN) y data together, so the two always have the same
+# length even if no frame ever arrives
+line.set_data(times, volt_buf)
+
+# The loop only reads binary blocks of known length, so turn off termination
+# character scanning for the rest of the run.
+scope.read_termination = None
+
+# --- Capture Pipeline (runs on a background thread, see scope_pipeline.py) ---
+def capture_frame():
+    # --- Trigger and Get the Raw Waveform Data in One Command ---
+    # ;*WAI makes the scope hold back the CURVE? response until the acquisition
+    # has completed, which replaces the separate *OPC? round-trip.
+    if log_timings:
+        start_time = time.perf_counter()
+    scope.write('ACQUIRE:STATE ON;*WAI;:CURVE?')
+    
+    # --- TEKTRONIX HEADER STRIPPING ---
+    # Tektronix returns an IEEE 488.2 header (e.g. #42500...) before the data.
+    # Reading it first tells us exactly how many bytes follow, so each read has
+    # an expected length and nothing scans the binary data for '\n'.
+    header = scope.read_bytes(2)
+    # The second byte tells us how many digits follow to indicate length
+    len_digits = header[1] - 0x30
+    if header[:1] != b'#' or not 0 < len_digits <= 9:
+        raise ValueError(f"Response is not a definite-length IEEE 488.2 block: {header!r}")
+    num_bytes = int(scope.read_bytes(len_digits))
+    waveform_bytes = scope.read_bytes(num_bytes)
+    scope.read_bytes(1) # Trailing newline
+    
+    if log_timings:
+        logging.debug("  read_bytes() took %.6f s", time.perf_counter() - start_time)
+    return np.frombuffer(waveform_bytes, dtype=np.int8)
+
+# A failed read leaves the rest of the response in the input buffer, which would
+# misalign every later read. scope.clear() (device clear) discards it.
+capture = CapturePipeline(capture_frame, NUM_CAPTURES, PIPELINE_DEPTH, on_error=scope.clear)
+
 # --- Acquisition Loop ---
 print("\nStarting capture loop...")
+all_rates = []
+actual_rate = 0.0
+last_paint = 0.0
+capture.start()
 for i in range(NUM_CAPTURES):
     loop_start_time = time.time()
     
     try:
-        start_time = time.perf_counter()
-        scope.write('ACQUIRE:STATE ON')
-        duration = time.perf_counter() - start_time
-        logging.info(f"  ACQUIRE:STATE ON took {duration:.6f} s")
-        
-        start_time = time.perf_counter()
-        scope.query('*OPC?') 
-        duration = time.perf_counter() - start_time
-        logging.info(f"  *OPC? took {duration:.6f} s")
-
-        # --- Get the Raw Waveform Data ---
-        start_time = time.perf_counter()
-        scope.write('CURVE?')
-        
-        # Read raw bytes
-        waveform_bytes = scope.read_raw()
-        
-        # --- TEKTRONIX HEADER STRIPPING ---
-        # Tektronix returns an IEEE 488.2 header (e.g. #42500...) before the data.
-        # We need to strip this, or the first few data points will be garbage.
-        if waveform_bytes[0:1] == b'#':
-            # The second byte tells us how many digits follow to indicate length
-            len_digits = int(chr(waveform_bytes[1]))
-            # The header length is 2 + len_digits (Example: #42500 is 2 + 4 = 6 bytes)
-            header_len = 2 + len_digits
-            waveform_bytes = waveform_bytes[header_len:-1] # Strip header and trailing newline
-        
-        duration = time.perf_counter() - start_time
-        logging.info(f"  read_raw() took {duration:.6f} s")
-        
-        raw_waveform = np.frombuffer(waveform_bytes, dtype=np.int8)
+        raw_waveform = capture.get()
+        if raw_waveform is None:
+            # The capture thread stopped early (e.g. after a timeout)
+            break
+        if isinstance(raw_waveform, Exception):
+            raise raw_waveform
 
         # --- Data Processing ---
-        start_time = time.perf_counter()
-        
-        # Ensure we don't have a mismatch in array length due to parsing
-        if len(raw_waveform) != num_points:
-             # Sometimes the read buffer might include termination chars, truncate to num_points
-             raw_waveform = raw_waveform[:num_points]
-
-        voltages = (raw_waveform.astype(np.float32) - y_zero + y_offset) * y_multiplier
-        times = np.arange(0, len(raw_waveform)) * x_increment + x_origin
-
-        # --- Update Live Plot ---
-        line.set_xdata(times)
-        line.set_ydata(voltages)
-        ax.relim()
-        ax.autoscale_view()
-        fig.canvas.draw()
-        fig.canvas.flush_events()
+        n = load_frame(raw_waveform, raw_buf, volt_buf, rescale_full, rescale_offset, rescale_gain)
+
+        # --- Update Live Plot (at most PLOT_REFRESH_HZ times per second) ---
+        now = time.perf_counter()
+        if now - last_paint >= 1.0 / PLOT_REFRESH_HZ:
+            # The title is redrawn with the line, so it is only set here too
+            # (showing the rate of the last completed frame)
+            line.set_ydata(volt_buf)
+            ax.set_title(f"Live Waveform (Capture {i+1}/{NUM_CAPTURES}, Rate: {actual_rate:.2f} Hz)")
+            fig.canvas.draw_idle()
+            fig.canvas.flush_events()
+            last_paint = now
         
         loop_end_time = time.time()
         elapsed_time = loop_end_time - loop_start_time
         actual_rate = 1.0 / elapsed_time if elapsed_time > 0 else 0
+        all_rates.append(actual_rate)
 
-        ax.set_title(f"Live Waveform (Capture {i+1}/{NUM_CAPTURES}, Rate: {actual_rate:.2f} Hz)")
-        logging.info(f"Capture {i+1}/{NUM_CAPTURES} complete. Rate: {actual_rate:.2f} Hz")
+        if log_timings:
+            logging.debug("Capture %d/%d complete. Rate: %.2f Hz", i + 1, NUM_CAPTURES, actual_rate)
 
     except Exception as e:
         logging.error(f"An error occurred during capture {i+1}: {e}")
-        if "Timeout" in str(e):
+        if is_timeout(e):
             logging.warning("Timeout Error: The scope may not be triggering.")
             break
         continue
 
 # --- Cleanup ---
-logging.info("Acquisition complete.")
+average_rate = np.mean(all_rates) if all_rates else 0
+logging.info(f"Acquisition complete. Average rate: {average_rate:.2f} Hz")
+capture.stop()
 scope.close()
 rm.close() # Clean up the Resource Manager
 
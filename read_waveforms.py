@@ -0,0 +1,62 @@
+import json
+import sys
+import numpy as np
+
+# --- Offline Reader for Binary Runs ---
+# acquire.py and acquire_ag.py save every capture as raw int8 ADC samples in
+# run_<timestamp>.i8, with the scaling parameters in run_<timestamp>.json.
+# Captures that failed or were never taken are left as all-zero rows; the
+# sidecar's 'captured' list names the rows holding a complete frame, and only
+# those are loaded.
+# This script converts such a run back to time/voltage and writes one CSV per
+# capture, in the same format the acquisition scripts used to produce.
+
+
+def load_run(run_name):
+    with open(f'{run_name}.json') as f:
+        params = json.load(f)
+
+    num_points = params['num_points']
+    raw = np.memmap(f'{run_name}.i8', dtype=params['dtype'], mode='r',
+                    shape=(params['num_captures'], num_points))
+    if 'captured' in params:
+        captured = np.array(params['captured'], dtype=np.intp)
+    else:
+        # The acquisition never reached cleanup, so there is no record of which
+        # rows were written
+        print(f"Warning: {run_name}.json has no 'captured' list, loading every row")
+        captured = np.arange(params['num_captures'])
+    raw = raw[captured]
+
+    times = np.arange(0, num_points) * params['x_increment'] + params['x_origin']
+    if params['scope'] == 'agilent':
+        voltages = (raw.astype(np.float32) - params['y_reference']) * params['y_increment'] + params['y_origin']
+    else:
+        voltages = (raw.astype(np.float32) - params['y_zero'] + params['y_offset']) * params['y_multiplier']
+    return times, voltages, captured
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python read_waveforms.py run_<timestamp>")
+        exit()
+
+    # Accept the run name with or without the .i8/.json extension
+    run_name = sys.argv[1]
+    if run_name.endswith(('.i8', '.json')):
+        run_name = run_name.rsplit('.', 1)[0]
+
+    times, voltages, captured = load_run(run_name)
+
+    # One C-contiguous (N, 2) buffer for every CSV: the time column never changes,
+    # so only the voltage column is rewritten per capture. It is float64 so the
+    # time column keeps full resolution with a large x_origin; the float32
+    # voltages convert to it exactly, and are printed with float32 precision.
+    save_buf = np.empty((len(times), 2), dtype=np.float64)
+    save_buf[:, 0] = times
+    # Files keep the capture number, so gaps show which captures were skipped
+    for row, i in enumerate(captured):
+        filename = f'{run_name}_waveform_{i+1:03d}.csv'
+        save_buf[:, 1] = voltages[row]
+        np.savetxt(filename, save_buf, fmt=('%.15e', '%.8e'), delimiter=',', header='Time(s),Voltage(V)', comments='')
+    print(f"Wrote {len(voltages)} waveforms from {run_name}.i8")
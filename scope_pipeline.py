@@ -0,0 +1,212 @@
+import json
+import queue
+import threading
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# --- Shared Acquisition Pipeline ---
+# Block parsing, voltage rescaling, the background capture thread and the raw
+# .i8 writer used by acquire.py, acquire_ag.py and acquire_pyvisa.py. Keeping
+# them in one place keeps the scripts' stop and error handling identical.
+
+
+# --- Voltage Rescaling Kernel ---
+# Converts int8 ADC samples to volts in one pass into a preallocated float32
+# array: (raw - y_zero + y_offset) * y_multiplier == (raw - a) * m, with
+# a = y_zero - y_offset precomputed once. Uses Numba when it is installed.
+# a and m are passed as float32 so the loop stays in float32, and with fastmath
+# and no bounds checks LLVM vectorizes it into widen/convert/multiply SIMD ops
+# (vpmovsxbd/vcvtdq2ps on AVX2, sshll/scvtf on NEON); see rescale.inspect_asm().
+if njit is not None:
+    @njit(cache=True, fastmath=True, boundscheck=False)
+    def rescale(raw, a, m, out):
+        n = min(raw.shape[0], out.shape[0])
+        for j in range(n):
+            out[j] = (np.float32(raw[j]) - a) * m
+        return out[:n]
+else:
+    # Without Numba, fall back to two in-place ufunc passes (no temporaries)
+    def rescale(raw, a, m, out):
+        n = min(raw.shape[0], out.shape[0])
+        np.subtract(raw[:n], a, out=out[:n], dtype=np.float32)
+        np.multiply(out[:n], m, out=out[:n])
+        return out[:n]
+
+def make_rescale(num_points):
+    # num_points is fixed for the whole run, so compile a kernel with it baked in as
+    # a loop-bound constant: LLVM can then unroll by the SIMD width and drop the
+    # scalar remainder loop. Only valid for full-length frames.
+    if njit is None:
+        return rescale
+
+    @njit(fastmath=True, boundscheck=False)
+    def rescale_fixed(raw, a, m, out):
+        for j in range(num_points):
+            out[j] = (np.float32(raw[j]) - a) * m
+        return out
+    return rescale_fixed
+
+def load_frame(raw, raw_buf, volt_buf, rescale_full, a, m):
+    # Copies one frame into the persistent buffers and rescales it to volts.
+    # Over-long reads are truncated, short reads are padded with NaN so the cached
+    # time axis still lines up. Returns the number of samples kept.
+    n = min(len(raw), len(raw_buf))
+    np.copyto(raw_buf[:n], raw[:n])
+    if n == len(raw_buf):
+        rescale_full(raw_buf, a, m, volt_buf)
+    else:
+        rescale(raw_buf[:n], a, m, volt_buf)
+        volt_buf[n:] = np.nan
+    return n
+
+
+# --- IEEE 488.2 Binary Block Parsing ---
+# Waveform data arrives as #<k><k digits giving n><n data bytes>\n. The header is
+# parsed in O(1) and np.frombuffer views the payload in place (no copy, and no
+# scanning of the binary data for a newline).
+def parse_block(waveform_bytes):
+    mv = memoryview(waveform_bytes)
+    if mv[0:1] != b'#':
+        raise ValueError("Response is not an IEEE 488.2 binary block")
+    k = mv[1] - 0x30
+    if k == 0:
+        # Indefinite-length block: data runs up to the trailing newline
+        return np.frombuffer(mv[2:-1], dtype=np.int8)
+    n = int(bytes(mv[2:2 + k]))
+    return np.frombuffer(mv, dtype=np.int8, count=n, offset=2 + k)
+
+
+# pyusb reports "Operation timed out", PyVISA "Timeout expired ..."
+def is_timeout(error):
+    message = str(error).lower()
+    return 'timeout' in message or 'timed out' in message
+
+
+# --- Capture Pipeline ---
+# All scope I/O runs on a background thread that always keeps the next capture in
+# flight, while the main thread processes the previous one. pyusb releases the
+# GIL while it waits on the bus, so USB transfers overlap with the Python-side
+# processing.
+#
+# capture() returns one int8 array per call and is called num_captures times.
+# With frame_points set, each array is split into rows of that many points and
+# the rows are queued one by one (FastFrame). Errors are queued in place of a
+# frame; a timeout ends the run, anything else moves on to the next capture.
+# on_error(), if given, is called after every other failed capture so the
+# connection can be resynchronised before the next one; if that fails too the
+# run ends. The worker always finishes by queueing None. on_frame(), if given,
+# is called on the capture thread after every item it queues, so an event-driven
+# consumer can be woken instead of polling.
+class CapturePipeline:
+    def __init__(self, capture, num_captures, depth, frame_points=None, on_error=None,
+                 on_frame=None):
+        self.frames = queue.Queue(maxsize=depth)
+        self._capture = capture
+        self._num_captures = num_captures
+        self._frame_points = frame_points
+        self._on_error = on_error
+        self._on_frame = on_frame
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def get(self, block=True):
+        return self.frames.get(block)
+
+    def _put(self, item):
+        self.frames.put(item)
+        if self._on_frame is not None:
+            self._on_frame()
+
+    def _run(self):
+        for _ in range(self._num_captures):
+            if self._stop.is_set():
+                break
+            try:
+                block = self._capture()
+            except Exception as e:
+                self._put(e)
+                if is_timeout(e):
+                    break
+                if self._on_error is not None:
+                    try:
+                        self._on_error()
+                    except Exception as recover_error:
+                        # Can't resynchronise, so stop rather than read garbage
+                        self._put(recover_error)
+                        break
+                continue
+            if self._frame_points is None:
+                self._put(block)
+                continue
+            usable = len(block) // self._frame_points * self._frame_points
+            for frame in block[:usable].reshape(-1, self._frame_points):
+                if self._stop.is_set():
+                    break
+                self._put(frame)
+        self._put(None)
+
+    def stop(self):
+        # Keep draining so a worker blocked on a full queue can see the stop flag
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self.frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+
+# --- Raw Output File ---
+# Raw int8 ADC samples from every capture go into one (num_captures, num_points)
+# memory-mapped run_<timestamp>.i8 file, 4x smaller than float32 and lossless.
+# The scaling parameters are written once to a .json sidecar. The writer thread
+# owns the file: the acquisition loop only queues a copy of each frame's samples,
+# so it never blocks on the filesystem. Use read_waveforms.py to convert a run to
+# time/voltage (or CSV) offline.
+#
+# Rows of failed, short or never-taken captures stay all zero in the .i8 file, so
+# close() records the rows that hold a complete frame as 'captured' in the
+# sidecar and read_waveforms.py skips the rest.
+class RawWriter:
+    def __init__(self, run_name, params, num_captures, num_points, queue_size):
+        self.run_name = run_name
+        self._params = dict(params, dtype='int8', num_captures=num_captures,
+                            num_points=num_points)
+        self._write_params()
+        self._mm = np.memmap(f'{run_name}.i8', dtype=np.int8, mode='w+',
+                             shape=(num_captures, num_points))
+        self._captured = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, index, samples):
+        self._queue.put((index, samples.copy()))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            index, samples = item
+            self._mm[index, :len(samples)] = samples
+            if len(samples) == self._mm.shape[1]:
+                self._captured.append(index)
+        self._mm.flush()
+
+    def _write_params(self):
+        with open(f'{self.run_name}.json', 'w') as f:
+            json.dump(self._params, f, indent=2)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._params['captured'] = sorted(self._captured)
+        self._write_params()